@@ -1,11 +1,23 @@
 import streamlit as st
 import rasterio
+from rasterio.enums import Resampling
 import numpy as np
 import plotly.graph_objects as go
-import cv2  # Untuk resize array
+from numba import njit, prange
+import xxhash
+import numexpr as ne
 import warnings
 
+# CuPy opsional: hanya dipakai jika terpasang dan ada GPU CUDA
+try:
+    import cupy
+    if cupy.cuda.runtime.getDeviceCount() == 0:
+        cupy = None
+except Exception:
+    cupy = None
+
 warnings.filterwarnings("ignore")
+ne.set_num_threads(min(ne.detect_number_of_cores(), ne.MAX_THREADS))
 
 # Judul Aplikasi
 st.title("🌊 Simulasi Banjir Interaktif Berbasis Topografi DEM")
@@ -16,102 +28,366 @@ rain_mm_per_hour = st.sidebar.slider("Intensitas Hujan (mm/jam)", 10, 1000, 300)
 duration_minutes = st.sidebar.slider("Durasi Hujan (menit)", 10, 600, 120)
 threshold = st.sidebar.slider("Ambang Genangan (m)", 0.01, 0.5, 0.1)
 mode = st.sidebar.selectbox("Mode Tampilan", ["Ringan", "Detail"])
+ponding = st.sidebar.checkbox("Model Genangan Fisik (priority-flood)", value=False)
+view_3d = st.sidebar.checkbox("Tampilan 3D", value=False)
 
 # Batas resolusi
 MAX_RES = 150 if mode == "Ringan" else 300
 ANIM_STEPS = 10 if mode == "Ringan" else 20
+VIZ_MAX_RES = 150  # Resolusi maksimum surface yang dikirim ke browser
+
+# Reduksi akhir antar baris (serial, tanpa atomic) untuk hasil maksimum per baris
+@njit(cache=True)
+def _reduce_rows(row_max, row_arg):
+    max_i = 0
+    for i in range(1, row_max.shape[0]):
+        if row_max[i] > row_max[max_i]:
+            max_i = i
+    return row_max[max_i], max_i, row_arg[max_i]
+
+# Kernel genangan: hitung tinggi air sekaligus cari titik maksimumnya
+@njit(cache=True, parallel=True, fastmath=True)
+def flood_kernel(elevation, emin, volume, out):
+    rows, cols = elevation.shape
+    row_max = np.zeros(rows, dtype=out.dtype)
+    row_arg = np.zeros(rows, dtype=np.int64)
+    for i in prange(rows):
+        best = 0.0
+        best_j = 0
+        for j in range(cols):
+            v = volume + emin - elevation[i, j]
+            if v < 0:
+                v = 0.0
+            out[i, j] = v
+            if v > best:
+                best = v
+                best_j = j
+        row_max[i] = best
+        row_arg[i] = best_j
+
+    return _reduce_rows(row_max, row_arg)
+
+# Nilai maksimum beserta indeksnya dalam satu pass paralel
+@njit(cache=True, parallel=True)
+def argmax_2d(a):
+    rows, cols = a.shape
+    row_max = np.empty(rows, dtype=a.dtype)
+    row_arg = np.zeros(rows, dtype=np.int64)
+    for i in prange(rows):
+        best = a[i, 0]
+        best_j = 0
+        for j in range(1, cols):
+            if a[i, j] > best:
+                best = a[i, j]
+                best_j = j
+        row_max[i] = best
+        row_arg[i] = best_j
+
+    return _reduce_rows(row_max, row_arg)
+
+# Min-heap biner sederhana (kunci elevasi, nilai indeks sel) untuk priority-flood
+@njit(cache=True)
+def _heap_push(keys, idxs, size, key, idx):
+    pos = size
+    keys[pos] = key
+    idxs[pos] = idx
+    while pos > 0:
+        parent = (pos - 1) // 2
+        if keys[parent] <= keys[pos]:
+            break
+        keys[parent], keys[pos] = keys[pos], keys[parent]
+        idxs[parent], idxs[pos] = idxs[pos], idxs[parent]
+        pos = parent
+    return size + 1
+
+@njit(cache=True)
+def _heap_pop(keys, idxs, size):
+    key = keys[0]
+    idx = idxs[0]
+    size -= 1
+    keys[0] = keys[size]
+    idxs[0] = idxs[size]
+    pos = 0
+    while True:
+        left = 2 * pos + 1
+        right = left + 1
+        smallest = pos
+        if left < size and keys[left] < keys[smallest]:
+            smallest = left
+        if right < size and keys[right] < keys[smallest]:
+            smallest = right
+        if smallest == pos:
+            break
+        keys[smallest], keys[pos] = keys[pos], keys[smallest]
+        idxs[smallest], idxs[pos] = idxs[pos], idxs[smallest]
+        pos = smallest
+    return key, idx, size
+
+# Priority-flood: isi cekungan DEM sampai setinggi titik limpasnya (O(N log N))
+@njit(cache=True)
+def priority_flood(dem):
+    rows, cols = dem.shape
+    filled = dem.copy()
+    closed = np.zeros((rows, cols), dtype=np.bool_)
+    keys = np.empty(rows * cols, dtype=np.float64)
+    idxs = np.empty(rows * cols, dtype=np.int64)
+    size = 0
+
+    # Semua sel tepi menjadi titik awal
+    for i in range(rows):
+        for j in range(cols):
+            if i == 0 or j == 0 or i == rows - 1 or j == cols - 1:
+                closed[i, j] = True
+                size = _heap_push(keys, idxs, size, filled[i, j], i * cols + j)
+
+    while size > 0:
+        level, idx, size = _heap_pop(keys, idxs, size)
+        ci = idx // cols
+        cj = idx % cols
+        for di in range(-1, 2):
+            for dj in range(-1, 2):
+                ni = ci + di
+                nj = cj + dj
+                if ni < 0 or nj < 0 or ni >= rows or nj >= cols or closed[ni, nj]:
+                    continue
+                closed[ni, nj] = True
+                if filled[ni, nj] < level:
+                    filled[ni, nj] = level
+                size = _heap_push(keys, idxs, size, filled[ni, nj], ni * cols + nj)
+    return filled
+
+# Isi piksel NaN dengan elevasi minimum secara in-place (tanpa salinan array)
+@njit(cache=True, parallel=True)
+def fill_nan_with_min(a):
+    rows, cols = a.shape
+    row_min = np.full(rows, np.inf)
+    for i in prange(rows):
+        m = np.inf
+        for j in range(cols):
+            v = a[i, j]
+            if not np.isnan(v) and v < m:
+                m = v
+        row_min[i] = m
+    fill = row_min.min()
+
+    for i in prange(rows):
+        for j in range(cols):
+            if np.isnan(a[i, j]):
+                a[i, j] = fill
+    return a
 
-# Fungsi caching untuk membaca DEM
+# Fungsi caching untuk membaca DEM (kunci cache: hash xxh3 isi file, file sendiri tidak di-hash)
 @st.cache_data
-def load_dem(uploaded_file):
-    with rasterio.open(uploaded_file) as dataset:
-        elevation = dataset.read(1)
-        elevation = np.nan_to_num(elevation, nan=np.nanmin(elevation))
+def load_dem(dem_hash, _uploaded_file, max_res):
+    with rasterio.open(_uploaded_file) as dataset:
+        # Perkecil DEM langsung saat dibaca agar tidak overload
+        # (hanya diperkecil, tidak pernah diperbesar)
+        rows, cols = dataset.height, dataset.width
+        scale = min(max_res / rows, max_res / cols)
+        if scale < 1:
+            out_shape = (max(1, round(rows * scale)), max(1, round(cols * scale)))
+            data = dataset.read(1, masked=True, out_shape=out_shape, resampling=Resampling.average)
+        else:
+            data = dataset.read(1, masked=True)
+
+        if np.issubdtype(data.dtype, np.integer) and data.dtype.itemsize <= 2:
+            # DEM integer (mis. SRTM/ASTER int16) tetap integer; nodata diisi elevasi minimum
+            elevation = data.filled(data.min())
+        else:
+            elevation = np.ma.filled(data.astype(np.float32, copy=False), np.nan)
+            fill_nan_with_min(elevation)
         bounds = dataset.bounds
     return elevation, bounds
 
-# Upload file DEM
-st.subheader("🗂️ Unggah File DEM (.tif)")
-dem_file = st.file_uploader("Unggah file DEM (GeoTIFF .tif)", type=["tif"])
+# Pilih modul array (CuPy/NumPy); GPU hanya sepadan untuk array besar
+GPU_MIN_CELLS = 1_000_000
 
-if dem_file is not None:
-    elevation, bounds = load_dem(dem_file)
+def get_array_module(n_cells):
+    if cupy is not None and n_cells > GPU_MIN_CELLS:
+        return cupy
+    return np
+
+# Kuantisasi tinggi air ke uint16 (0..65535) agar payload Plotly lebih kecil
+Z_LEVELS = 65535
+
+# (dikerjakan in-place pada `a` untuk menghindari array sementara)
+def quantize_z(a, zscale):
+    np.multiply(a, zscale, out=a)
+    np.clip(a, 0, Z_LEVELS, out=a)
+    return a.astype(np.uint16)
+
+# Label sumbu Z / colorbar tetap dalam meter meskipun data yang dikirim sudah dikuantisasi
+def meter_ticks(zscale, n_ticks=6):
+    tickvals = np.linspace(0, Z_LEVELS, n_ticks)
+    return dict(
+        title='Tinggi Air (m)',
+        tickvals=tickvals,
+        ticktext=[f"{v / zscale:.2f}" for v in tickvals]
+    )
+
+# Nilai hover masih dalam satuan kuantisasi (konversi ke meter butuh array teks per sel)
+HOVER_TEMPLATE = "X: %{x:.2f}<br>Y: %{y:.2f}<br>Tinggi air (skala 0-65535): %{z}<extra></extra>"
+
+# Trace genangan: heatmap 2-D (ringan, default) atau surface 3-D
+# Rentang warna tetap 0..Z_LEVELS agar warna konsisten antar frame dan colorbar dalam meter
+def water_trace(z, x, y, view_3d, zscale, showscale=True):
+    if view_3d:
+        return dict(type='surface', z=z, x=x, y=y, colorscale='Blues', showscale=showscale,
+                    cmin=0, cmax=Z_LEVELS, colorbar=meter_ticks(zscale), hovertemplate=HOVER_TEMPLATE)
+    return dict(type='heatmap', z=z, x=x, y=y, colorscale='Blues', showscale=showscale,
+                zmin=0, zmax=Z_LEVELS, colorbar=meter_ticks(zscale), hovertemplate=HOVER_TEMPLATE)
+
+# Pengaturan sumbu sesuai mode tampilan
+def axes_layout(view_3d, zscale):
+    if view_3d:
+        return dict(scene=dict(
+            zaxis=dict(meter_ticks(zscale), range=[0, Z_LEVELS]),
+            xaxis_title='X (m)',
+            yaxis_title='Y (m)'
+        ))
+    return dict(xaxis_title='X (m)', yaxis=dict(title='Y (m)', scaleanchor='x'))
 
-    # Resize DEM agar tidak overload
-    scale = min(MAX_RES / elevation.shape[0], MAX_RES / elevation.shape[1])
-    elevation = cv2.resize(elevation, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+# Kedalaman air hujan total (m)
+def inflow_depth(rain_mm_per_hour, duration_minutes):
+    rainfall_intensity = float(rain_mm_per_hour) / 3600 / 1000
+    duration = float(duration_minutes) * 60
+    return rainfall_intensity * duration
 
+# Kapasitas tampung cekungan (dipakai bersama oleh simulasi statis dan animasi)
+@st.cache_data
+def ponding_capacity(elevation):
+    capacity = priority_flood(elevation)
+    np.subtract(capacity, elevation, out=capacity)
+    return capacity
+
+# Fungsi caching untuk simulasi genangan statis
+@st.cache_data
+def compute_simulation(elevation, bounds, rain_mm_per_hour, duration_minutes, ponding):
     rows, cols = elevation.shape
     x = np.linspace(bounds.left, bounds.right, cols)
     y = np.linspace(bounds.top, bounds.bottom, rows)
-    X, Y = np.meshgrid(x, y)
 
     # Simulasi hujan
-    rainfall_intensity = rain_mm_per_hour / 3600 / 1000
-    duration = duration_minutes * 60
-    inflow_volume = rainfall_intensity * duration
+    inflow_volume = inflow_depth(rain_mm_per_hour, duration_minutes)
+
+    if ponding:
+        # Air hanya tertampung di cekungan, maksimal setinggi curah hujan
+        water_level = np.minimum(ponding_capacity(elevation), np.float32(inflow_volume))
+        max_water, max_i, max_j = argmax_2d(water_level)
+    else:
+        # Hitung genangan
+        emin = elevation.min()
+        water_level = np.empty(elevation.shape, dtype=np.float32)
+        max_water, max_i, max_j = flood_kernel(elevation, emin, inflow_volume, water_level)
+
+    # Langkah terakhir animasi sama dengan kondisi statis, jadi skala ini berlaku untuk keduanya
+    zmax = float(max_water)
+    # Tanpa genangan sama sekali (mis. lereng tanpa cekungan), skala mengikuti kedalaman hujan
+    zscale = Z_LEVELS / (zmax if zmax > 0 else inflow_volume)
+    water_q = quantize_z(water_level, zscale)
+
+    return x, y, water_q, (max_water, max_i, max_j), zscale
 
-    # Hitung genangan
-    water_level = np.maximum(0, inflow_volume - elevation + np.min(elevation))
-    max_pos = np.unravel_index(np.argmax(water_level), water_level.shape)
-    max_water = water_level[max_pos]
+# Fungsi caching untuk frame animasi (hanya dihitung jika diminta)
+@st.cache_data
+def compute_animation(elevation, rain_mm_per_hour, duration_minutes, steps, ponding, zscale):
+    rows, cols = elevation.shape
+    inflow_volume = inflow_depth(rain_mm_per_hour, duration_minutes)
+    volumes = inflow_volume * np.arange(1, steps + 1, dtype=np.float32) / steps
+
+    # Tinggi air tiap langkah animasi disimpan sebagai array 3-D (steps, rows, cols)
+    if ponding:
+        stack = np.minimum(ponding_capacity(elevation)[None], volumes[:, None, None])
+    else:
+        emin = elevation.min()
+        xp = get_array_module(steps * rows * cols)
+        base2d = np.subtract(emin, elevation, dtype=np.float32)
+        if xp is np:
+            # Penjumlahan dan pemotongan nol digabung dalam satu pass (numexpr)
+            stack = np.empty((steps, rows, cols), dtype=np.float32)
+            ne.evaluate("where(b + v > 0, b + v, 0)",
+                        local_dict={'b': base2d[None], 'v': volumes[:, None, None]}, out=stack)
+        else:
+            stack = xp.asarray(base2d)[None] + xp.asarray(volumes)[:, None, None]
+            xp.maximum(stack, 0, out=stack)
+            stack = cupy.asnumpy(stack)
+
+    return quantize_z(stack, zscale)
+
+# Upload file DEM
+st.subheader("🗂️ Unggah File DEM (.tif)")
+dem_file = st.file_uploader("Unggah file DEM (GeoTIFF .tif)", type=["tif"])
+
+if dem_file is not None:
+    # Hash isi file cukup dihitung sekali per rerun
+    dem_hash = xxhash.xxh3_64(dem_file.getbuffer()).hexdigest()
+    elevation, bounds = load_dem(dem_hash, dem_file, MAX_RES)
+    x, y, water_q, (max_water, max_i, max_j), zscale = compute_simulation(
+        elevation, bounds, rain_mm_per_hour, duration_minutes, ponding
+    )
+    max_pos = (max_i, max_j)
+
+    # Perkecil hanya untuk tampilan; deteksi genangan tetap memakai resolusi penuh
+    viz_stride = max(1, -(-max(water_q.shape) // VIZ_MAX_RES))
+    x_viz = x[::viz_stride]
+    y_viz = y[::viz_stride]
+    water_viz = water_q[::viz_stride, ::viz_stride]
 
     # Notifikasi banjir
     if max_water > threshold:
-        st.error(f"⚠️ Banjir! Genangan {max_water:.2f} m di X={X[max_pos]:.2f}, Y={Y[max_pos]:.2f}")
+        st.error(f"⚠️ Banjir! Genangan {max_water:.2f} m di X={x[max_pos[1]]:.2f}, Y={y[max_pos[0]]:.2f}")
     else:
         st.success("✅ Tidak ada genangan melebihi ambang batas.")
 
-    # Visualisasi 3D Statis
-    st.subheader("📊 Visualisasi 3D Genangan (Interaktif)")
-    fig = go.Figure(data=[go.Surface(z=water_level, x=X, y=Y, colorscale='Blues')])
-    fig.update_layout(scene=dict(
-        zaxis_title='Tinggi Air (m)',
-        xaxis_title='X (m)',
-        yaxis_title='Y (m)'
-    ), height=600)
+    # Visualisasi Statis
+    st.subheader("📊 Visualisasi Genangan (Interaktif)")
+    fig = go.Figure(data=[water_trace(water_viz, x_viz, y_viz, view_3d, zscale)])
+    fig.update_layout(**axes_layout(view_3d, zscale), height=600)
     st.plotly_chart(fig)
 
     # Simulasi Animasi Genangan
     st.subheader("🎞️ Animasi Genangan Air")
     durasi_animasi = st.slider("Durasi Animasi (detik)", 2, 30, 10)
 
-    frames = []
-    for t in range(1, ANIM_STEPS + 1):
-        volume_t = inflow_volume * (t / ANIM_STEPS)
-        level_t = np.maximum(0, volume_t - elevation + np.min(elevation))
-        surface = go.Surface(z=level_t, x=X, y=Y, colorscale='Blues', showscale=False)
-        frame = go.Frame(data=[surface])
-        frames.append(frame)
-
-    initial_surface = frames[0].data[0]
-    fig_anim = go.Figure(data=[initial_surface], frames=frames)
-
-    fig_anim.update_layout(
-        updatemenus=[{
-            "buttons": [
-                {"args": [None, {"frame": {"duration": int(durasi_animasi * 1000 / ANIM_STEPS), "redraw": True},
-                                 "fromcurrent": True}],
-                 "label": "▶ Play", "method": "animate"},
-                {"args": [[None], {"frame": {"duration": 0}, "mode": "immediate"}],
-                 "label": "⏹ Pause", "method": "animate"}
-            ],
-            "direction": "left",
-            "pad": {"r": 10, "t": 87},
-            "type": "buttons",
-            "x": 0.1,
-            "xanchor": "right",
-            "y": 0,
-            "yanchor": "top"
-        }],
-        scene=dict(
-            zaxis_title='Tinggi Air (m)',
-            xaxis_title='X (m)',
-            yaxis_title='Y (m)'
-        ),
-        height=600
-    )
-    st.plotly_chart(fig_anim)
+    # Animasi hanya dibuat setelah diminta, dan tetap tampil selama parameternya tidak berubah
+    anim_params = (dem_hash, MAX_RES, rain_mm_per_hour, duration_minutes, ANIM_STEPS, ponding)
+    if st.button("Buat Animasi"):
+        st.session_state.animation_params = anim_params
+
+    if st.session_state.get("animation_params") == anim_params:
+        stack_q = compute_animation(elevation, rain_mm_per_hour, duration_minutes, ANIM_STEPS, ponding, zscale)
+        stack_viz = stack_q[:, ::viz_stride, ::viz_stride]
+
+        # Frame hanya membawa z; x/y diambil dari trace awal
+        frames = [
+            go.Frame(data=[dict(type='surface' if view_3d else 'heatmap', z=stack_viz[t])], name=str(t))
+            for t in range(ANIM_STEPS)
+        ]
+
+        initial_trace = water_trace(stack_viz[0], x_viz, y_viz, view_3d, zscale, showscale=False)
+        fig_anim = go.Figure(data=[initial_trace], frames=frames)
+
+        fig_anim.update_layout(
+            updatemenus=[{
+                "buttons": [
+                    {"args": [None, {"frame": {"duration": int(durasi_animasi * 1000 / ANIM_STEPS), "redraw": True},
+                                     "fromcurrent": True}],
+                     "label": "▶ Play", "method": "animate"},
+                    {"args": [[None], {"frame": {"duration": 0}, "mode": "immediate"}],
+                     "label": "⏹ Pause", "method": "animate"}
+                ],
+                "direction": "left",
+                "pad": {"r": 10, "t": 87},
+                "type": "buttons",
+                "x": 0.1,
+                "xanchor": "right",
+                "y": 0,
+                "yanchor": "top"
+            }],
+            **axes_layout(view_3d, zscale),
+            height=600
+        )
+        st.plotly_chart(fig_anim)
 
 else:
     st.info("🚨 Silakan unggah file DEM (.tif) untuk memulai simulasi.")